@@ -1,19 +1,50 @@
+import gc
+import hashlib
 import json
+import lzma
 import re
 import tarfile
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from io import BytesIO
-from typing import Dict, Tuple, List
+from pathlib import Path
+from typing import Dict, FrozenSet, Tuple, List
 
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
 from wordfreq import top_n_list
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 N = 4000
 
 # FreeDict Spanish->English source archive (TEI XML inside)
 FREEDICT_SRC_TAR_XZ = "https://download.freedict.org/dictionaries/spa-eng/0.3.1/freedict-spa-eng-0.3.1.src.tar.xz"
 
-UA = {"User-Agent": "spanish-flashcards-builder/2.0 (personal study)"}
+UA = {
+    "User-Agent": "spanish-flashcards-builder/2.0 (personal study)",
+    # requests decodes these transparently; br needs the brotli package.
+    "Accept-Encoding": "gzip, deflate, br",
+}
+
+CACHE_DIR = Path.home() / ".cache" / "spanish-flashcards"
+
+# One pooled session for every fetch: keep-alive reuses the TCP+TLS
+# connection instead of paying a fresh handshake per request.
+SESSION = requests.Session()
+SESSION.headers.update(UA)
+SESSION.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=3),
+)
+
+# Compiled once; these run inside the per-entry TEI loop.
+_RE_WS = re.compile(r"\s+")
+_RE_NON_ALPHA = re.compile(r"[^a-z]")
 
 POS_MAP = {
     "noun": "noun",
@@ -34,125 +65,190 @@ POS_MAP = {
     "determiner": "determiner",
 }
 
+def normalize_token(s: str) -> str:
+    """Canonical lemma form: NFC, lowercased, whitespace collapsed."""
+    return " ".join(unicodedata.normalize("NFC", s or "").lower().split())
+
+# FreeDict uses only a handful of distinct POS strings, so memoizing
+# turns the per-entry regex work into a dict hit.
+@lru_cache(maxsize=512)
 def norm_pos(pos: str) -> str:
     p = (pos or "").strip().lower()
-    p = re.sub(r"[^a-z]", "", p)
+    p = _RE_NON_ALPHA.sub("", p)
     return POS_MAP.get(p, "other")
 
 def is_verb(pos: str) -> bool:
-    return norm_pos(pos) == "verb"
+    # pos is already canonical (norm_pos runs at parse time).
+    return pos == "verb"
 
 def clean_english(s: str) -> str:
-    s = re.sub(r"\s+", " ", (s or "").strip())
+    s = _RE_WS.sub(" ", (s or "").strip())
     return s.strip(" ;,")
 
 def ensure_to_for_verbs(en: str, pos: str) -> str:
     en = clean_english(en)
-    if is_verb(pos) and en and not en.lower().startswith("to "):
+    if is_verb(pos) and en and en[:3].lower() != "to ":
         return "to " + en
     return en
 
-def download_freedict_src() -> bytes:
-    r = requests.get(FREEDICT_SRC_TAR_XZ, headers=UA, timeout=120)
-    r.raise_for_status()
-    return r.content
-
-def extract_tei_from_tar_xz(tar_xz_bytes: bytes) -> bytes:
-    bio = BytesIO(tar_xz_bytes)
-    with tarfile.open(fileobj=bio, mode="r:xz") as tf:
-        members = tf.getmembers()
-        tei_member = None
-
-        # Prefer the main TEI dictionary file
-        for m in members:
-            name = m.name.lower()
-            if ("tei" in name or name.endswith(".tei") or name.endswith(".tei.xml")) and "readme" not in name and "license" not in name:
-                tei_member = m
-                break
-
-        if not tei_member:
-            for m in members:
-                if m.name.lower().endswith((".tei", ".tei.xml", ".xml")):
-                    tei_member = m
-                    break
+def cached_download(url: str) -> Path:
+    """Download url into the on-disk cache and return the cached path.
+
+    Stores ETag/Last-Modified alongside the body and revalidates with a
+    conditional GET, so an unchanged upstream costs one tiny 304 round
+    trip instead of a multi-MB transfer.
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = CACHE_DIR / hashlib.sha1(url.encode()).hexdigest()
+    meta_path = path.with_suffix(".meta.json")
+
+    headers = {}
+    if path.exists() and meta_path.exists():
+        try:
+            meta = json.loads(meta_path.read_text())
+        except (OSError, ValueError):
+            meta = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    with SESSION.get(url, headers=headers, stream=True, timeout=120) as r:
+        if r.status_code == 304:
+            return path
+        r.raise_for_status()
+        with open(path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=1 << 16):
+                f.write(chunk)
+        meta_path.write_text(json.dumps({
+            "url": url,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+        }))
+    return path
+
+def _tei_rank(name: str):
+    """Rank a tar member as a TEI candidate; lower is better, None skips."""
+    name = name.lower()
+    if "readme" in name or "license" in name:
+        return None
+    if name.endswith((".tei", ".tei.xml")):
+        return 0
+    if "tei" in name and name.endswith(".xml"):
+        return 1
+    if name.endswith(".xml"):
+        return 2
+    return None
 
-        if not tei_member:
-            raise RuntimeError("Could not find TEI/XML in FreeDict source tar.xz")
+def fetch_freedict_tei() -> bytes:
+    """Fetch the FreeDict tar.xz (cached on disk) and return the TEI bytes.
 
-        f = tf.extractfile(tei_member)
-        if not f:
-            raise RuntimeError("Could not extract TEI/XML from FreeDict archive.")
-        return f.read()
+    The archive is streamed through lzma into a streaming tar reader,
+    so the decompressed archive is never buffered in memory.
+    """
+    tar_xz_path = cached_download(FREEDICT_SRC_TAR_XZ)
+    best_rank = None
+    best_data = None
+    with lzma.open(tar_xz_path) as xz, tarfile.open(fileobj=xz, mode="r|") as tf:
+        for m in tf:
+            if not m.isfile():
+                continue
+            rank = _tei_rank(m.name)
+            if rank is None or (best_rank is not None and rank >= best_rank):
+                continue
+            f = tf.extractfile(m)
+            if not f:
+                continue
+            data = f.read()
+            if rank == 0:
+                return data
+            best_rank, best_data = rank, data
 
-def parse_freedict_tei(tei_xml: bytes) -> Dict[str, Tuple[str, str]]:
-    soup = BeautifulSoup(tei_xml, "lxml-xml")
+    if best_data is None:
+        raise RuntimeError("Could not find TEI/XML in FreeDict source tar.xz")
+    return best_data
+
+# Compiled once; each call runs a single C-level traversal of the entry
+# subtree and returns "" when nothing matches, so no None checks needed.
+# local-name() keeps them working with or without the TEI namespace.
+_XP_ORTH = etree.XPath("string((.//*[local-name()='orth'])[1])")
+_XP_POS = etree.XPath("string((.//*[local-name()='pos'])[1])")
+_XP_GRAM_POS = etree.XPath("string((.//*[local-name()='gram'][@type='pos'])[1])")
+_XP_TRANS_QUOTE = etree.XPath(
+    "string((.//*[local-name()='cit'][@type='trans']/*[local-name()='quote'])[1])"
+)
+_XP_ANY_QUOTE = etree.XPath("string((.//*[local-name()='quote'])[1])")
+
+def parse_freedict_tei(tei_xml: bytes, wanted: FrozenSet[str]) -> Dict[str, Tuple[str, str]]:
     mapping: Dict[str, Tuple[str, str]] = {}
 
-    for entry in soup.find_all("entry"):
-        orth = entry.find("orth")
-        if not orth:
-            continue
-        head = orth.get_text(" ", strip=True).lower()
-        head = re.sub(r"\s+", " ", head).strip()
-        if not head:
-            continue
-
-        pos = ""
-        pos_tag = entry.find("pos")
-        if pos_tag:
-            pos = pos_tag.get_text(" ", strip=True)
-        if not pos:
-            gram = entry.find("gram", attrs={"type": "pos"})
-            if gram:
-                pos = gram.get_text(" ", strip=True)
-        pos = norm_pos(pos)
-
-        gloss = ""
-        cit = entry.find("cit", attrs={"type": "trans"})
-        if cit:
-            q = cit.find("quote")
-            if q:
-                gloss = q.get_text(" ", strip=True)
-        if not gloss:
-            q = entry.find("quote")
-            if q:
-                gloss = q.get_text(" ", strip=True)
-        gloss = clean_english(gloss)
-
-        if head not in mapping and gloss:
-            mapping[head] = (gloss, pos)
+    # Stream entry-by-entry instead of building the whole multi-MB DOM.
+    # "{*}entry" matches regardless of the TEI default namespace.
+    for _, entry in etree.iterparse(BytesIO(tei_xml), events=("end",), tag="{*}entry"):
+        head = normalize_token(_XP_ORTH(entry))
+
+        # Only the ~N top-frequency lemmas are ever looked up, so skip
+        # the pos/gloss extraction for everything else.
+        if head in wanted and head not in mapping:
+            pos = norm_pos(_XP_POS(entry) or _XP_GRAM_POS(entry))
+            gloss = clean_english(_XP_TRANS_QUOTE(entry) or _XP_ANY_QUOTE(entry))
+
+            if gloss:
+                mapping[head] = (gloss, pos)
+                if len(mapping) == len(wanted):
+                    break
+
+        # Free the processed subtree so memory stays flat while streaming.
+        entry.clear(keep_tail=True)
+        while entry.getprevious() is not None:
+            del entry.getparent()[0]
 
     return mapping
 
-def main():
-    print("Getting top words from wordfreq…")
-    top: List[str] = top_n_list("es", N)
+def _fetch_inputs() -> Tuple[List[str], bytes]:
+    # The wordfreq data load and the FreeDict download are independent;
+    # overlap them so total time is the slower of the two, not the sum.
+    print("Fetching top words and FreeDict spa-eng source…")
+    try:
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            fut_top = ex.submit(top_n_list, "es", N)
+            fut_tei = ex.submit(fetch_freedict_tei)
+            return fut_top.result(), fut_tei.result()
+    finally:
+        SESSION.close()
 
-    print("Downloading FreeDict spa-eng source…")
-    tar_xz = download_freedict_src()
+def main():
+    top, tei = _fetch_inputs()
 
-    print("Extracting TEI/XML…")
-    tei = extract_tei_from_tar_xz(tar_xz)
+    # Defensive order-preserving de-dup; dict.fromkeys runs the whole
+    # pass in C and duplicate cards would otherwise reach words.json.
+    top = list(dict.fromkeys(top))
 
     print("Parsing FreeDict…")
-    lex = parse_freedict_tei(tei)
+    lex = parse_freedict_tei(tei, frozenset(top))
+
+    # The raw TEI bytes are the largest object left; drop them before
+    # assembling the output so peak memory stays at one big buffer.
+    del tei
+    gc.collect()
 
+    no_hit = ("", "other")
     out = []
-    missing = 0
+    # wordfreq tokens are already lowercase NFC, no per-word cleanup needed.
     for w in top:
-        w = w.strip().lower()
-        en = ""
-        pos = "other"
-        if w in lex:
-            en, pos = lex[w]
-        else:
-            missing += 1
-
+        en, pos = lex.get(w, no_hit)
         en = ensure_to_for_verbs(en, pos)
         out.append({"spanish": w, "english": en, "partOfSpeech": pos})
 
-    with open("words.json", "w", encoding="utf-8") as f:
-        json.dump(out, f, ensure_ascii=False)
+    # lex only holds heads drawn from top, so the hit count is its size.
+    missing = len(top) - len(lex)
+
+    if orjson is not None:
+        with open("words.json", "wb") as f:
+            f.write(orjson.dumps(out))
+    else:
+        with open("words.json", "w", encoding="utf-8") as f:
+            json.dump(out, f, ensure_ascii=False, separators=(",", ":"))
 
     print(f"Done. Wrote {len(out)} items to words.json. Missing translations: {missing}")
 